@@ -74,8 +74,7 @@ class ReplayBuffer:
         next_idx = self.next_idx + size
 
         if self.if_per:
-            for data_id in (np.arange(self.next_idx, next_idx) % self.max_len):
-                self.tree.update_ids(data_id)
+            self.tree.update_ids(data_ids=np.arange(self.next_idx, next_idx) % self.max_len)
 
         if next_idx > self.max_len:
             if next_idx > self.max_len:
@@ -1,13 +1,20 @@
+import io
 import os
 import time
+import queue
+import threading
 import torch
 import torch.nn as nn
-from torch.distributions import MultivariateNormal
+from torch.distributions import MultivariateNormal, Normal, Independent
 import numpy as np
 import numpy.random as rd
-from copy import deepcopy
 from tensorboardX import SummaryWriter
 
+try:
+    import numba  # optional, compile the sum-tree of PER and the statistics of records
+except ImportError:
+    numba = None
+
 
 def layer_norm(layer, std=1.0, bias_const=1e-6):
     torch.nn.init.orthogonal_(layer.weight, std)
@@ -15,9 +22,10 @@ def layer_norm(layer, std=1.0, bias_const=1e-6):
 
 
 class ActorMPO(nn.Module):
-    def __init__(self, mid_dim, state_dim, action_dim):
+    def __init__(self, mid_dim, state_dim, action_dim, if_diag_cov=False):
         super().__init__()
         self.action_dim = action_dim
+        self.if_diag_cov = if_diag_cov  # diagonal Gaussian, log_prob and KL cost O(dim) instead of O(dim^3)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         lay_dim = mid_dim
@@ -26,29 +34,42 @@ class ActorMPO(nn.Module):
                                        nn.Linear(mid_dim, lay_dim), nn.ReLU())
         # nn.Linear(mid_dim, lay_dim), nn.Hardswish())
         self.net_a_loc = nn.Linear(lay_dim, action_dim)  # the average of action
-        self.net_a_cholesky = nn.Linear(lay_dim, (action_dim * (action_dim + 1)) // 2)
+        self.net_a_cholesky = nn.Linear(lay_dim, action_dim if if_diag_cov else (action_dim * (action_dim + 1)) // 2)
         self.softplus = nn.Softplus(threshold=18.)
         layer_norm(self.net_a_loc, std=0.01)  # output layer for action, it is no necessary.
         layer_norm(self.net_a_cholesky, std=0.01)
 
+        # constant indices of the cholesky vector, not saved in state_dict
+        cholesky_diag_index = torch.arange(action_dim, dtype=torch.long) + 1
+        cholesky_diag_index = (cholesky_diag_index * (cholesky_diag_index + 1)) // 2 - 1
+        tril_indices = torch.tril_indices(row=action_dim, col=action_dim, offset=0)
+        self.register_buffer('cholesky_diag_index', cholesky_diag_index, persistent=False)
+        self.register_buffer('tril_row', tril_indices[0], persistent=False)
+        self.register_buffer('tril_col', tril_indices[1], persistent=False)
+
     def forward(self, state):
         return self.net_a_loc(self.net_state(state)).tanh()  # action
 
     def get_distribution(self, state):
         loc, cholesky = self.get_loc_cholesky(state)
+        return self.build_distribution(loc, cholesky)
+
+    def build_distribution(self, loc, cholesky):
+        """cholesky is the scale (B, dim-a) of each dimension if if_diag_cov, else scale_tril (B, dim-a, dim-a)
+        """
+        if self.if_diag_cov:
+            return Independent(Normal(loc=loc, scale=cholesky), 1)
         return MultivariateNormal(loc=loc, scale_tril=cholesky)
 
     def get_loc_cholesky(self, state):
         t_tmp = self.net_state(state)
         a_loc = self.net_a_loc(t_tmp)  # NOTICE! it is a_loc without .tanh()
         a_cholesky_vector = self.net_a_cholesky(t_tmp)
-        cholesky_diag_index = torch.arange(self.action_dim, dtype=torch.long) + 1
-        cholesky_diag_index = (cholesky_diag_index * (cholesky_diag_index + 1)) // 2 - 1
-        a_cholesky_vector[:, cholesky_diag_index] = self.softplus(a_cholesky_vector[:, cholesky_diag_index])
-        tril_indices = torch.tril_indices(row=self.action_dim, col=self.action_dim, offset=0)
-        a_cholesky = torch.zeros(size=(a_loc.shape[0], self.action_dim, self.action_dim), dtype=torch.float32,
-                                 device=t_tmp.device)
-        a_cholesky[:, tril_indices[0], tril_indices[1]] = a_cholesky_vector
+        if self.if_diag_cov:
+            return a_loc, self.softplus(a_cholesky_vector)
+        a_cholesky_vector[:, self.cholesky_diag_index] = self.softplus(a_cholesky_vector[:, self.cholesky_diag_index])
+        a_cholesky = a_cholesky_vector.new_zeros((a_loc.shape[0], self.action_dim, self.action_dim))
+        a_cholesky[:, self.tril_row, self.tril_col] = a_cholesky_vector
         return a_loc, a_cholesky
 
     def get_action(self, state):
@@ -63,10 +84,14 @@ class ActorMPO(nn.Module):
 class CriticTwin(nn.Module):
     def __init__(self, mid_dim, state_dim, action_dim, if_use_dn=False):
         super().__init__()
+        self.state_dim = state_dim
 
         self.net_sa = nn.Sequential(nn.Linear(state_dim + action_dim, mid_dim), nn.ReLU(),
                                     nn.Linear(mid_dim, mid_dim), nn.ReLU(),
                                     nn.Linear(mid_dim, mid_dim), nn.ReLU())
+        # the layers after the first linear layer, a tuple is not registered as a submodule (same state_dict),
+        # and `self.net_sa[1:]` would build a new nn.Sequential on every call
+        self.net_sa_tail = tuple(self.net_sa)[1:]
         out_dim = mid_dim
         self.net_q1 = nn.Linear(out_dim, 1)
         self.net_q2 = nn.Linear(out_dim, 1)
@@ -74,13 +99,84 @@ class CriticTwin(nn.Module):
         layer_norm(self.net_q2, std=0.1)
 
     def forward(self, state, action):
-        tmp = self.net_sa(torch.cat((state, action), dim=1))
+        tmp = self.get_tail(self.get_first_layer(state, action))
         return self.net_q1(tmp)  # one Q value
 
     def get_q1_q2(self, state, action):
-        tmp = self.net_sa(torch.cat((state, action), dim=1))
+        tmp = self.get_tail(self.get_first_layer(state, action))
+        return self.net_q1(tmp), self.net_q2(tmp)  # two Q values
+
+    def get_q1_q2_sampled(self, state, sampled_action):
+        """two Q values of N sampled actions for each state
+
+        the state part of the first layer is computed once for (B, dim-s) instead of (N * B, dim-s).
+        :return q1, q2: shape==(N * B, 1)
+        """
+        tmp = self.get_first_layer(state, sampled_action)  # (N, B, mid)
+        tmp = self.get_tail(tmp.reshape(-1, tmp.shape[-1]))
         return self.net_q1(tmp), self.net_q2(tmp)  # two Q values
 
+    def get_tail(self, tmp):
+        for layer in self.net_sa_tail:
+            tmp = layer(tmp)
+        return tmp
+
+    def get_first_layer(self, state, action):
+        """net_sa[0](torch.cat((state, action), dim=1)) without the concatenated tensor
+
+        the weight of the first linear layer is split into state and action columns.
+        """
+        layer = self.net_sa[0]
+        h_s = nn.functional.linear(state, layer.weight[:, :self.state_dim], layer.bias)
+        h_a = nn.functional.linear(action, layer.weight[:, self.state_dim:])
+        return h_a.add_(h_s)
+
+
+def _tree_update_id(prob_ary, min_ary, tree_id, prob):
+    prob_ary[tree_id] = prob
+    min_ary[tree_id] = prob
+
+    while tree_id != 0:  # propagate the change through tree
+        tree_id = (tree_id - 1) // 2
+        prob_ary[tree_id] = prob_ary[2 * tree_id + 1] + prob_ary[2 * tree_id + 2]
+        min_ary[tree_id] = min(min_ary[2 * tree_id + 1], min_ary[2 * tree_id + 2])
+
+
+def _tree_update_ids(prob_ary, min_ary, ids, probs):
+    for i in range(ids.shape[0]):
+        prob_ary[ids[i]] = probs[i]
+        min_ary[ids[i]] = probs[i]
+
+    for i in range(ids.shape[0]):  # propagate the change through tree
+        tree_id = ids[i]
+        while tree_id != 0:
+            tree_id = (tree_id - 1) // 2
+            prob_ary[tree_id] = prob_ary[2 * tree_id + 1] + prob_ary[2 * tree_id + 2]
+            min_ary[tree_id] = min(min_ary[2 * tree_id + 1], min_ary[2 * tree_id + 2])
+
+
+def _tree_get_leaf_ids(prob_ary, values, now_len):
+    max_len = prob_ary.shape[0]
+    leaf_ids = np.empty(values.shape[0], dtype=np.int64)
+    for i in range(values.shape[0]):
+        v = values[i]
+        parent_idx = 0
+        while 2 * parent_idx + 1 < max_len:  # downward search until reach bottom
+            l_idx = 2 * parent_idx + 1
+            if v <= prob_ary[l_idx]:
+                parent_idx = l_idx
+            else:
+                v -= prob_ary[l_idx]
+                parent_idx = l_idx + 1
+        leaf_ids[i] = min(parent_idx, now_len - 2)
+    return leaf_ids
+
+
+if numba is not None:
+    _tree_update_id = numba.njit(cache=True)(_tree_update_id)
+    _tree_update_ids = numba.njit(cache=True)(_tree_update_ids)
+    _tree_get_leaf_ids = numba.njit(cache=True)(_tree_get_leaf_ids)
+
 
 class BinarySearchTree:
     """Binary Search Tree for PER
@@ -92,8 +188,12 @@ class BinarySearchTree:
 
     def __init__(self, memo_len):
         self.memo_len = memo_len  # replay buffer len
-        self.prob_ary = np.zeros((memo_len - 1) + memo_len)  # parent_nodes_num + leaf_nodes_num
+        # parent_nodes_num + leaf_nodes_num, float32 halves the memory walked by each search
+        self.prob_ary = np.zeros((memo_len - 1) + memo_len, dtype=np.float32)
+        # the same tree storing the min priority, so is_weights need not scan all the leaves
+        self.min_ary = np.full_like(self.prob_ary, np.inf)
         self.max_len = len(self.prob_ary)
+        self.rng = np.random.default_rng(rd.randint(2 ** 31 - 1))  # seeded by np.random.seed() before training
         self.now_len = self.memo_len - 1  # pointer
         self.indices = None
         self.depth = int(np.log2(self.max_len))
@@ -109,29 +209,42 @@ class BinarySearchTree:
         if self.now_len == tree_id:
             self.now_len += 1
 
-        delta = prob - self.prob_ary[tree_id]
+        if numba is not None:
+            _tree_update_id(self.prob_ary, self.min_ary, tree_id, prob)
+            return
+
         self.prob_ary[tree_id] = prob
+        self.min_ary[tree_id] = prob
 
         while tree_id != 0:  # propagate the change through tree
             tree_id = (tree_id - 1) // 2  # faster than the recursive loop
-            self.prob_ary[tree_id] += delta
+            # sum the children rather than add a delta, so float32 rounding errors do not accumulate
+            self.prob_ary[tree_id] = self.prob_ary[2 * tree_id + 1] + self.prob_ary[2 * tree_id + 2]
+            self.min_ary[tree_id] = min(self.min_ary[2 * tree_id + 1], self.min_ary[2 * tree_id + 2])
 
     def update_ids(self, data_ids, prob=10):  # 10 is max_prob
         ids = data_ids + self.memo_len - 1
         self.now_len += (ids >= self.now_len).sum()
 
-        upper_step = self.depth - 1
+        if numba is not None:
+            probs = np.broadcast_to(np.asarray(prob, dtype=self.prob_ary.dtype), ids.shape)
+            _tree_update_ids(self.prob_ary, self.min_ary, np.ascontiguousarray(ids, dtype=np.int64),
+                             np.ascontiguousarray(probs))
+            return
+
         self.prob_ary[ids] = prob  # here, ids means the indices of given children (maybe the right ones or left ones)
-        p_ids = (ids - 1) // 2
+        self.min_ary[ids] = prob
+        p_ids = np.unique((ids - 1) // 2)  # sorted, and each parent only once
 
-        while upper_step:  # propagate the change through tree
+        while True:  # propagate the change through tree, level by level for the whole batch
             ids = p_ids * 2 + 1  # in this while loop, ids means the indices of the left children
             self.prob_ary[p_ids] = self.prob_ary[ids] + self.prob_ary[ids + 1]
+            self.min_ary[p_ids] = np.minimum(self.min_ary[ids], self.min_ary[ids + 1])
+            p_ids = p_ids[p_ids > 0]  # leaves of a non-full tree may reach the root earlier
+            if p_ids.size == 0:
+                break
             p_ids = (p_ids - 1) // 2
-            upper_step -= 1
-
-        self.prob_ary[0] = self.prob_ary[1] + self.prob_ary[2]
-        # because we take depth-1 upper steps, ps_tree[0] need to be updated alone
+            p_ids = p_ids[np.r_[True, p_ids[1:] != p_ids[:-1]]]  # (x-1)//2 keeps p_ids sorted, drop the duplicates
 
     def get_leaf_id(self, v):
         """Tree structure and array storage:
@@ -159,37 +272,62 @@ class BinarySearchTree:
                     parent_idx = r_idx
         return min(leaf_idx, self.now_len - 2)  # leaf_idx
 
+    def get_leaf_ids(self, values):
+        """Batched version of get_leaf_id: all values walk down the tree together, one level per step.
+        """
+        values = np.array(values, dtype=self.prob_ary.dtype)
+        if numba is not None:
+            return _tree_get_leaf_ids(self.prob_ary, values, self.now_len)
+
+        parent_ids = np.zeros(values.shape[0], dtype=np.int64)
+        while True:
+            l_ids = 2 * parent_ids + 1  # the leaf's left node
+            if_node = l_ids < self.max_len  # False means reach bottom
+            if not if_node.any():
+                break
+            l_ids[~if_node] = 0  # keep the gather in range, these ids are not used
+            l_probs = self.prob_ary[l_ids]
+            if_right = if_node & (values > l_probs)
+            values -= np.where(if_right, l_probs, 0)
+            parent_ids = np.where(if_node, l_ids + if_right, parent_ids)
+        return np.minimum(parent_ids, self.now_len - 2)  # leaf_ids
+
     def get_indices_is_weights(self, batch_size, beg, end):
         self.per_beta = min(1., self.per_beta + 0.001)
 
         # get random values for searching indices with proportional prioritization
-        values = (rd.rand(batch_size) + np.arange(batch_size)) * (self.prob_ary[0] / batch_size)
+        values = (self.rng.random(batch_size, dtype=np.float32) + np.arange(batch_size, dtype=np.float32)) \
+                 * (self.prob_ary[0] / batch_size)
 
         # get proportional prioritization
-        leaf_ids = np.array([self.get_leaf_id(v) for v in values])
+        leaf_ids = self.get_leaf_ids(values)
         self.indices = leaf_ids - (self.memo_len - 1)
 
-        prob_ary = self.prob_ary[leaf_ids] / self.prob_ary[beg:end].min()
+        prob_ary = self.prob_ary[leaf_ids] / self.min_ary[0]  # min_ary[0] is the min of the stored leaves
         is_weights = np.power(prob_ary, -self.per_beta)  # important sampling weights
         return self.indices, is_weights
 
     def td_error_update(self, td_error):  # td_error = (q-q).detach_().abs()
         prob = td_error.squeeze().clamp(1e-6, 10).pow(self.per_alpha)
-        prob = prob.cpu().numpy()
+        prob = prob.to(torch.float32).cpu().numpy()
         self.update_ids(self.indices, prob)
 
 
 class ReplayBuffer:
-    def __init__(self, cwd, max_len, state_dim, action_dim, if_per, if_save_buffer=False):
+    def __init__(self, cwd, max_len, state_dim, action_dim, if_per, if_save_buffer=False,
+                 reward_scale=1.0, gamma=0.99):
         """Experience Replay Buffer
 
         save environment transition in a continuous RAM for high performance training
-        we save trajectory in order and save state and other (action, reward, mask, ...) separately.
+        we save trajectory in order, each row is a transition (state, action, reward, mask),
+        so one gather of rows samples all of them.
 
         `int max_len` the maximum capacity of ReplayBuffer. First In First Out
         `int state_dim` the dimension of state
         `int action_dim` the dimension of action (action_dim==1 for discrete action)
         `bool if_per` Prioritized Experience Replay for sparse reward
+        `float reward_scale` the reward is saved as reward * reward_scale
+        `float gamma` the mask is saved as 0.0 if done else gamma
         """
         self.cwd = cwd
         self.device = torch.device("cpu")
@@ -197,27 +335,41 @@ class ReplayBuffer:
         self.now_len = 0
         self.next_idx = 0
         self.if_full = False
+        self.state_dim = state_dim
         self.action_dim = action_dim
         self.if_per = if_per
         self.if_save_buffer = if_save_buffer
+        self.reward_scale = reward_scale
+        self.gamma = gamma
+        # sample_batch may run in the thread of _Prefetcher, its own generator (seeded by the global one)
+        # keeps the random numbers of the training thread in order
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(int(torch.randint(2 ** 62, size=(1,))))
         if if_per:
             self.tree = BinarySearchTree(max_len)
 
-        self.buf_state = torch.empty((max_len, state_dim), dtype=torch.float32, device=self.device)
-        self.buf_action = torch.empty((max_len, action_dim), dtype=torch.float32, device=self.device)
-        self.buf_reward = torch.empty((max_len, 1), dtype=torch.float32, device=self.device)
-        self.buf_mask = torch.empty((max_len, 1), dtype=torch.float32, device=self.device)
+        self.if_pin = torch.cuda.is_available()  # sample batch in page-locked RAM for non-blocking copy to GPU
 
-    def append_buffer(self, state, action, reward, mask):  # CPU array to CPU array
-        state = torch.as_tensor(state, dtype=torch.float32, device=self.device)
-        action = torch.as_tensor(action, dtype=torch.float32, device=self.device)
-        reward = torch.as_tensor(reward, dtype=torch.float32, device=self.device)
-        mask = torch.as_tensor(mask, dtype=torch.float32, device=self.device)
+        self.buf_row = torch.empty((max_len, state_dim + action_dim + 2), dtype=torch.float32, device=self.device)
+        self.set_buf_views()
 
-        self.buf_state[self.next_idx] = state
-        self.buf_action[self.next_idx] = action
-        self.buf_reward[self.next_idx] = reward
-        self.buf_mask[self.next_idx] = mask
+    def set_buf_views(self):
+        """buf_state, buf_action, buf_reward, buf_mask are the column views of buf_row
+
+        buf_row_np shares the memory of buf_row, append_buffer writes into it without creating tensors.
+        """
+        self.buf_row_np = self.buf_row.numpy()
+        self.buf_state = self.buf_row[:, :self.state_dim]
+        self.buf_action = self.buf_row[:, self.state_dim:-2]
+        self.buf_reward = self.buf_row[:, -2:-1]
+        self.buf_mask = self.buf_row[:, -1:]
+
+    def append_buffer(self, state, action, reward, done):  # CPU array to CPU array
+        row = self.buf_row_np[self.next_idx]  # numpy casts to float32 while copying into the row
+        row[:self.state_dim] = state
+        row[self.state_dim:-2] = action
+        row[-2] = reward * self.reward_scale
+        row[-1] = 0.0 if done else self.gamma
 
         if self.if_per:
             self.tree.update_id(self.next_idx)
@@ -232,43 +384,49 @@ class ReplayBuffer:
                 self.save_buffer()
                 self.if_save_buffer = False
 
-    def extend_buffer(self, state, action, reward, mask):  # CPU array to CPU array
-        state = torch.as_tensor(state, dtype=torch.float32, device=self.device)
-        action = torch.as_tensor(action, dtype=torch.float32, device=self.device)
-        reward = torch.as_tensor(reward, dtype=torch.float32, device=self.device)
-        mask = torch.as_tensor(mask, dtype=torch.float32, device=self.device)
+    def extend_buffer(self, state, action, reward, done):  # CPU array to CPU array
+        """write a block of transitions, each field is copied into the columns of buf_row_np at once
 
+        :array reward: reward.shape==(size, ), raw reward of env
+        :array done: done.shape==(size, ), bool
+        """
         size = len(state)
+        reward = np.reshape(reward, size) * self.reward_scale
+        mask = np.where(np.reshape(done, size), 0.0, self.gamma)
         next_idx = self.next_idx + size
 
         if self.if_per:
-            for data_id in (np.arange(self.next_idx, next_idx) % self.max_len):
-                self.tree.update_ids(data_id)
-
-        if next_idx > self.max_len:
-            if next_idx > self.max_len:
-                self.buf_state[self.next_idx:self.max_len] = state[:self.max_len - self.next_idx]
-                self.buf_action[self.next_idx:self.max_len] = action[:self.max_len - self.next_idx]
-                self.buf_reward[self.next_idx:self.max_len] = reward[:self.max_len - self.next_idx]
-                self.buf_mask[self.next_idx:self.max_len] = mask[:self.max_len - self.next_idx]
-            self.if_full = True
-            next_idx = next_idx - self.max_len
+            self.tree.update_ids(data_ids=np.arange(self.next_idx, next_idx) % self.max_len)
 
-            self.buf_state[0:next_idx] = state[-next_idx:]
-            self.buf_action[0:next_idx] = action[-next_idx:]
-            self.buf_reward[0:next_idx] = reward[-next_idx:]
-            self.buf_mask[0:next_idx] = mask[-next_idx:]
+        if next_idx > self.max_len:  # the block wraps around the end of buffer
+            part = self.max_len - self.next_idx
+            self.write_rows(self.next_idx, state[:part], action[:part], reward[:part], mask[:part])
+            self.write_rows(0, state[part:], action[part:], reward[part:], mask[part:])
         else:
-            self.buf_state[self.next_idx:next_idx] = state
-            self.buf_action[self.next_idx:next_idx] = action
-            self.buf_reward[self.next_idx:next_idx] = reward
-            self.buf_mask[self.next_idx:next_idx] = mask
+            self.write_rows(self.next_idx, state, action, reward, mask)
+        if next_idx >= self.max_len:
+            self.if_full = True
+            next_idx = next_idx - self.max_len
         self.next_idx = next_idx
 
-    def sample_batch(self, batch_size) -> tuple:
+        if self.if_full:
+            if self.if_save_buffer:
+                self.save_buffer()
+                self.if_save_buffer = False
+
+    def write_rows(self, beg, state, action, reward, mask):
+        size = len(state)
+        rows = self.buf_row_np[beg:beg + size]
+        rows[:, :self.state_dim] = np.reshape(state, (size, -1))
+        rows[:, self.state_dim:-2] = np.reshape(action, (size, -1))
+        rows[:, -2] = np.reshape(reward, size)
+        rows[:, -1] = np.reshape(mask, size)
+
+    def sample_batch(self, batch_size, device=None) -> tuple:
         """randomly sample a batch of data for training
 
         :int batch_size: the number of data in a batch for Stochastic Gradient Descent
+        :device device: move the batch to this device (non-blocking), None means keep it on self.device
         :return torch.Tensor reward: reward.shape==(now_len, 1)
         :return torch.Tensor mask:   mask.shape  ==(now_len, 1), mask = 0.0 if done else gamma
         :return torch.Tensor action: action.shape==(now_len, action_dim)
@@ -280,20 +438,36 @@ class ReplayBuffer:
             end = (self.now_len - self.max_len) if (self.now_len < self.max_len) else None
 
             indices, is_weights = self.tree.get_indices_is_weights(batch_size, beg, end)
-
-            return (self.buf_reward[indices],
-                    self.buf_mask[indices],
-                    self.buf_action[indices],
-                    self.buf_state[indices],
-                    self.buf_state[indices + 1],
-                    torch.as_tensor(is_weights, dtype=torch.float32, device=self.device))
+            indices = torch.as_tensor(indices, dtype=torch.long, device=self.device)
+            is_weights = torch.as_tensor(is_weights, dtype=torch.float32, device=device)
+            return self.gather_rows(indices, device) + (is_weights,)
         else:
-            indices = torch.randint(self.now_len - 1, size=(batch_size,), device=self.device)
-            return (self.buf_reward[indices],
-                    self.buf_mask[indices],
-                    self.buf_action[indices],
-                    self.buf_state[indices],
-                    self.buf_state[indices + 1])
+            indices = torch.randint(self.now_len - 1, size=(batch_size,), device=self.device, generator=self.generator)
+            return self.gather_rows(indices, device)
+
+    def gather_rows(self, indices, device=None):
+        rows = self.gather(self.buf_row, indices)
+        next_s = self.gather(self.buf_state, indices + 1)
+        if device is not None:
+            rows = rows.to(device, non_blocking=True)
+            next_s = next_s.to(device, non_blocking=True)
+        return (rows[:, -2:-1],  # reward
+                rows[:, -1:],  # mask
+                rows[:, self.state_dim:-2],  # action
+                rows[:, :self.state_dim],  # state
+                next_s)
+
+    def gather(self, buf, indices):
+        """gather the rows of buf, into page-locked RAM if a GPU will consume them
+
+        the pinned blocks are recycled by the caching host allocator of PyTorch,
+        and are not reused before the non-blocking copy from them is finished.
+        index_select (int64 indices) is a dedicated kernel, cheaper than advanced indexing `buf[indices]`.
+        """
+        if self.if_pin:
+            out = torch.empty((indices.shape[0], buf.shape[1]), dtype=buf.dtype, pin_memory=True)
+            return torch.index_select(buf, 0, indices, out=out)
+        return torch.index_select(buf, 0, indices)
 
     def update_now_len_before_sample(self):
         """update the a pointer `now_len`, which is the current data number of ReplayBuffer
@@ -308,39 +482,121 @@ class ReplayBuffer:
         self.if_full = False
 
     def save_buffer(self, file_name='buffer_data'):
+        """save the rows [state, action, reward, mask] of buf_row in one file, in one write
+        """
         self.update_now_len_before_sample()
         os.makedirs(self.cwd + '/' + file_name, exist_ok=True)
-        np.save(self.cwd + '/' + file_name + '/state', self.buf_state[:self.now_len].detach().numpy())
-        np.save(self.cwd + '/' + file_name + '/action', self.buf_action[:self.now_len].detach().numpy())
-        np.save(self.cwd + '/' + file_name + '/reward', self.buf_reward[:self.now_len].detach().numpy())
-        np.save(self.cwd + '/' + file_name + '/mask', self.buf_mask[:self.now_len].detach().numpy())
+        np.save(self.cwd + '/' + file_name + '/row', self.buf_row[:self.now_len].detach().cpu().numpy())
         print("Saved " + file_name + " in " + self.cwd)
 
     def load_buffer(self, file_path):
-        state = np.load(file_path + '/state.npy')
-        action = np.load(file_path + '/action.npy')
-        reward = np.load(file_path + '/reward.npy')
-        mask = np.load(file_path + '/mask.npy')
-        if state.shape[0] >= self.max_len:
-            print(f"Buffer len is too short, update max_len with {state.shape[0]}")
-            self.now_len = self.max_len = state.shape[0]
+        """load the buffer saved by save_buffer (or the four files state/action/reward/mask of old versions)
+
+        the file is memory-mapped (copy-on-write), and copied into buf_row once without a temporary tensor.
+        """
+        if os.path.exists(file_path + '/row.npy'):
+            row = np.load(file_path + '/row.npy', mmap_mode='c')
+        else:
+            row = np.concatenate([np.load(file_path + f'/{name}.npy', mmap_mode='c').reshape(-1, dim)
+                                  for name, dim in (('state', self.state_dim), ('action', self.action_dim),
+                                                    ('reward', 1), ('mask', 1))], axis=1)
+        data_len = row.shape[0]
+        if data_len >= self.max_len:
+            print(f"Buffer len is too short, update max_len with {data_len}")
+            self.now_len = self.max_len = data_len
             self.next_idx = 0
             self.if_full = True
-            self.buf_state = torch.tensor(state, dtype=torch.float32, device=self.device)
-            self.buf_action = torch.tensor(action, dtype=torch.float32, device=self.device)
-            self.buf_reward = torch.tensor(reward, dtype=torch.float32, device=self.device)
-            self.buf_mask = torch.tensor(mask, dtype=torch.float32, device=self.device)
+            self.buf_row = torch.empty((self.max_len, self.buf_row.shape[1]), dtype=torch.float32, device=self.device)
+            self.set_buf_views()
         else:
-            self.now_len = state.shape[0]
+            self.now_len = data_len
             self.next_idx = self.now_len
             self.if_full = False
-            self.buf_state[:state.shape[0], :] = torch.tensor(state, dtype=torch.float32, device=self.device)
-            self.buf_action[:state.shape[0], :] = torch.tensor(action, dtype=torch.float32, device=self.device)
-            self.buf_reward[:state.shape[0], :] = torch.tensor(reward, dtype=torch.float32, device=self.device)
-            self.buf_mask[:state.shape[0], :] = torch.tensor(mask, dtype=torch.float32, device=self.device)
+        self.buf_row[:data_len].copy_(torch.from_numpy(row))
         print("Loaded in " + file_path)
 
 
+class LaBERBuffer(ReplayBuffer):
+    def __init__(self, cwd, max_len, state_dim, action_dim, laber_m=4, if_save_buffer=False,
+                 reward_scale=1.0, gamma=0.99):
+        """Large Batch Experience Replay (LaBER), replace the sum-tree of PER
+
+        sample a uniform large batch (laber_m * batch_size),
+        the agent down-samples it to batch_size according to the TD-errors, see AgentMPO.get_obj_critic_laber
+        there is no priority to store or update.
+        `int laber_m` the large batch is laber_m times as large as the batch for SGD
+        """
+        super().__init__(cwd, max_len, state_dim, action_dim, if_per=False, if_save_buffer=if_save_buffer,
+                         reward_scale=reward_scale, gamma=gamma)
+        self.laber_m = laber_m
+
+    def sample_batch(self, batch_size, device=None) -> tuple:
+        """randomly sample a large batch, shape==(laber_m * batch_size, ...)
+        """
+        return super().sample_batch(batch_size * self.laber_m, device)
+
+
+class _Prefetcher:
+    def __init__(self, buffer, batch_size, device, batch_num):
+        """sample the next batches from ReplayBuffer in a background thread
+
+        a 1-slot queue keeps one batch ready while the current one is trained,
+        on GPU the batch is copied by a side CUDA stream.
+        call close() when the training stops early, else the thread waits on the full queue forever.
+        """
+        self.device = device
+        self.queue = queue.Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(buffer, batch_size, batch_num), daemon=True)
+        self.thread.start()
+
+    def run(self, buffer, batch_size, batch_num):
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        try:
+            for _ in range(batch_num):
+                if stream is None:
+                    batch = buffer.sample_batch(batch_size, device=self.device)
+                    event = None
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = buffer.sample_batch(batch_size, device=self.device)
+                        event = stream.record_event()
+                if not self.put((batch, event)):
+                    return
+        except Exception as error:  # raise it in the training thread
+            self.put((error, None))
+
+    def put(self, item):
+        """put item into the queue, return False if close() is called before there is space for it
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        """stop the thread, and drop the batch waiting in the queue
+        """
+        self.stop_event.set()
+        self.thread.join()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def next(self):
+        batch, event = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t in batch:
+                t.record_stream(current_stream)
+        return batch
+
+
 class AgentMPO():
     def __init__(self, args=None):
         self.device_name = "cpu" if args is None else args.device_name
@@ -357,6 +613,8 @@ class AgentMPO():
         self.init_log_alpha_stddev = 10. if args is None else args.agent['init_log_alpha_stddev']
         self._per_dim_constraining = True
         self._action_penalization = True
+        self.if_diag_cov = False if args is None else args.agent.get('if_diag_cov', False)
+        self.if_compile = False if args is None else args.agent.get('if_compile', False)
 
         self.MPO_FLOAT_EPSILON = 1e-8
         self.dual_learning_rate = 1e-2
@@ -364,7 +622,7 @@ class AgentMPO():
         self.update_period = 10
         self.train_record = {}
 
-    def init(self, net_dim, state_dim, action_dim, if_per=False):
+    def init(self, net_dim, state_dim, action_dim, if_per=False, if_laber=False):
         self.state_dim = state_dim
         self.action_dim = action_dim
         self.device = torch.device(self.device_name)
@@ -380,42 +638,62 @@ class AgentMPO():
                                                 self.log_alpha_stddev,
                                                 self.log_temperature), self.dual_learning_rate)
         self.log_num_actions = np.log(self._num_samples)
-        self.act = ActorMPO(net_dim, state_dim, action_dim).to(self.device)
-        self.act_target = deepcopy(self.act)
+        self.act = ActorMPO(net_dim, state_dim, action_dim, self.if_diag_cov).to(self.device)
+        self.act_target = ActorMPO(net_dim, state_dim, action_dim, self.if_diag_cov).to(self.device)
+        self.act_target.load_state_dict(self.act.state_dict())
+        self.act_target.requires_grad_(False)  # target networks are only updated by soft_update
         self.cri = CriticTwin(net_dim, state_dim, action_dim).to(self.device)
-        self.cri_target = deepcopy(self.cri)
+        self.cri_target = CriticTwin(net_dim, state_dim, action_dim).to(self.device)
+        self.cri_target.load_state_dict(self.cri.state_dict())
+        self.cri_target.requires_grad_(False)
+        self.if_on_device = True  # act and cri are on self.device, flipped by to_cpu() and to_device()
+        # parameter lists of soft_update, `module.to(device)` keeps the same Parameter objects
+        self.act_params = (list(self.act_target.parameters()), list(self.act.parameters()))
+        self.cri_params = (list(self.cri_target.parameters()), list(self.cri.parameters()))
 
         self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
         self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
-        self.criterion = torch.nn.SmoothL1Loss(reduction='none' if if_per else 'mean')
+        self.criterion = torch.nn.SmoothL1Loss(reduction='none' if (if_per or if_laber) else 'mean')
         self.softplus = torch.nn.Softplus(threshold=18)
-        self.get_obj_critic = self.get_obj_critic_raw
+        self.get_obj_critic = self.get_obj_critic_laber if if_laber else self.get_obj_critic_raw
+        self.get_mpo_losses = self.get_mpo_losses_raw
+        self.act_eval = self.act  # the forward of actor for evaluation, see compile_act()
 
-    @staticmethod
-    def select_action(policy, state, explore_rate=1.):
-        states = torch.as_tensor((state,), dtype=torch.float32).detach_()
+    @torch.inference_mode()
+    def select_action(self, policy, state, explore_rate=1.):
+        """the policy stays on self.device, only the state and the action cross the PCIe bus
+
+        :return array action: the sampled action before tanh, for ReplayBuffer
+        :return array action_tanh: tanh(action), for env.step()
+        """
+        states = torch.from_numpy(np.asarray(state, dtype=np.float32)).unsqueeze(0).to(self.device)
         action = policy.get_action(states)[0]
-        return action.detach().numpy()
+        return torch.stack((action, action.tanh())).cpu().numpy()  # one copy to CPU for both
 
     def update_net_multi_step(self, buffer, target_step, batch_size, repeat_times):
-        for i in range(int(target_step * repeat_times)):
-            if_record = True if i == (int(target_step * repeat_times) - 1) else False
-            train_record = self.update_net_one_step(buffer, batch_size, if_record)
+        update_times = int(target_step * repeat_times)
+        # PER updates the priorities of the last sampled indices, so it can not sample ahead
+        prefetcher = None if buffer.if_per else _Prefetcher(buffer, batch_size, self.device, update_times)
+        try:
+            for i in range(update_times):
+                if_record = True if i == (update_times - 1) else False
+                batch = None if prefetcher is None else prefetcher.next()
+                train_record = self.update_net_one_step(buffer, batch_size, if_record, batch=batch)
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
         return train_record
 
-    def update_net_one_step(self, buffer, batch_size, if_record):
+    def update_net_one_step(self, buffer, batch_size, if_record, batch=None):
         # Policy Evaluation
-        obj_critic, target_pi, target_q, next_s, sampled_a = self.get_obj_critic(buffer, batch_size)
+        obj_critic, target_pi, target_loc, target_cholesky, target_q, next_s, sampled_a = \
+            self.get_obj_critic(buffer, batch_size, batch=batch)
         self.cri_optimizer.zero_grad()
         obj_critic.backward()
         self.cri_optimizer.step()
         self.update_index += 1
-        self.soft_update(self.cri_target, self.cri, self.soft_update_tau)
+        self.soft_update(*self.cri_params, self.soft_update_tau)
         # Policy Improvation
-        # Sample N additional action for each state
-        alpha_mean = self.softplus(input=self.log_alpha_mean) + self.MPO_FLOAT_EPSILON
-        alpha_stddev = self.softplus(input=self.log_alpha_stddev) + self.MPO_FLOAT_EPSILON
-        temperature = self.softplus(input=self.log_temperature) + self.MPO_FLOAT_EPSILON
         online_loc, online_cholesky = self.act.get_loc_cholesky(next_s)  # (B,)
         # with torch.no_grad():
         #     sampled_a = target_pi.sample((self._num_samples,))  # (N, B, dim-a)
@@ -428,12 +706,89 @@ class AgentMPO():
         #     expanded_s.reshape(-1, state.shape[1]),  # (N * B, dim-s)
         #     sampled_a.tanh().reshape(-1, self.action_dim)  # (N * B, dim-a)
         # ).reshape(self._num_samples, batch_size)  # (N, B, dim-a)
+        mpo_inputs = (online_loc, online_cholesky, target_loc, target_cholesky, sampled_a, target_q,
+                      self.log_alpha_mean, self.log_alpha_stddev, self.log_temperature)
+        loss, loss_dual, record_values = self.get_mpo_losses(*mpo_inputs)
+        if self.if_compile and self.get_mpo_losses == self.get_mpo_losses_raw:
+            self.compile_mpo_losses(mpo_inputs)
+
+        # Lagrangian Dual Problem and Primal Problem
+        # loss_dual only reaches the dual variables and loss only reaches the actor, one backward serves both.
+        self.dual_optimizer.zero_grad()
+        self.act_optimizer.zero_grad()
+        (loss_dual + loss).backward()
+        self.dual_optimizer.step()
+        self.act_optimizer.step()
+
+        # self.update_index += 1
+        # if self.update_index // self.update_period == 1:
+        #     self.soft_update(*self.act_params, 1.)
+        #     self.update_index = 0
+        self.soft_update(*self.act_params, self.soft_update_tau)
+
+        # debug, copying to CPU waits for GPU, so only record when it is needed and copy all scalars at once
+        if if_record:
+            record_values = torch.cat((record_values[:4], obj_critic.detach().reshape(1), record_values[4:]))
+            self.train_record.update(zip(('a_avg', 'a_std', 't', 'obj_a', 'obj_c', 'obj_t', 'obj_d',
+                                          'kl_mean', 'kl_std', 'est_q'), record_values.cpu().tolist()))
+        return self.train_record
+
+    def compile_mpo_losses(self, mpo_inputs):
+        """compile get_mpo_losses after the first call, the shapes of a training step are fixed now
+
+        keep the eager one if the compiled forward or backward fails on the inputs of the first call.
+        The trial runs on detached copies of the inputs, the graph and the grads of the training step are not touched.
+        """
+        self.if_compile = False
+        get_mpo_losses = torch.compile(self.get_mpo_losses_raw, mode="reduce-overhead")
+        trial_inputs = tuple(x.detach().requires_grad_(x.requires_grad) for x in mpo_inputs)
+        try:
+            loss, loss_dual, _ = get_mpo_losses(*trial_inputs)
+            torch.autograd.grad(loss + loss_dual, [x for x in trial_inputs if x.requires_grad], allow_unused=True)
+        except Exception as error:
+            print(f"| torch.compile of MPO losses failed, keep eager mode: {type(error).__name__}")
+            return
+        self.get_mpo_losses = get_mpo_losses
+
+    def compile_act(self, batch_size):
+        """compile the forward of actor for evaluation, the input shape (batch_size, state_dim) is fixed
+
+        self.act is kept for training and saving, only self.act_eval is replaced.
+        try torch.compile, then torch.jit.trace (PyTorch < 2), keep the eager one if both fail on a trial input.
+        """
+        states = torch.zeros((batch_size, self.state_dim), dtype=torch.float32, device=self.device)
+        compilers = (('torch.compile', lambda: torch.compile(self.act, mode="reduce-overhead", fullgraph=True)),
+                     ('torch.jit.trace', lambda: torch.jit.trace(self.act, states)))
+        for name, compiler in compilers:
+            try:
+                act_eval = compiler()
+                with torch.inference_mode():
+                    act_eval(states)
+            except Exception as error:
+                print(f"| {name} of actor failed: {type(error).__name__}")
+                continue
+            self.act_eval = act_eval
+            return
+        print("| keep eager mode for actor")
+
+    def get_mpo_losses_raw(self, online_loc, online_cholesky, target_loc, target_cholesky, sampled_a, target_q,
+                           log_alpha_mean, log_alpha_stddev, log_temperature):
+        """the policy loss and the dual loss of MPO, a pure function of its inputs for torch.compile
+
+        :return loss: the loss of actor
+        :return loss_dual: the loss of the Lagrangian multipliers
+        :return record_values: (a_avg, a_std, t, obj_a, obj_t, obj_d, kl_mean, kl_std, est_q), no grad
+        """
+        alpha_mean = self.softplus(input=log_alpha_mean) + self.MPO_FLOAT_EPSILON
+        alpha_stddev = self.softplus(input=log_alpha_stddev) + self.MPO_FLOAT_EPSILON
+        temperature = self.softplus(input=log_temperature) + self.MPO_FLOAT_EPSILON
 
         # Decompose the online policy into fixed-mean & fixed-stddev distributions.
         # This has been documented as having better performance in bandit settings,
         # see e.g. https://arxiv.org/pdf/1812.02256.pdf.
-        fixed_stddev_dist = MultivariateNormal(online_loc, scale_tril=target_pi.scale_tril)
-        fixed_mean_dist = MultivariateNormal(target_pi.loc, scale_tril=online_cholesky)
+        target_pi = self.act.build_distribution(target_loc, target_cholesky)
+        fixed_stddev_dist = self.act.build_distribution(online_loc, target_cholesky)
+        fixed_mean_dist = self.act.build_distribution(target_loc, online_cholesky)
         # Computes normalized importance weights for the policy optimization.
         tempered_q_values = target_q / temperature  # no grad
         normalized_weights = torch.softmax(tempered_q_values, dim=0).detach_()  # no grad
@@ -458,9 +813,6 @@ class AgentMPO():
                                                                                         self.epsilon)
         # loss_dual = loss_alpha_mean + loss_alpha_stddev + loss_temperature
         loss_dual = loss_temperature
-        self.dual_optimizer.zero_grad()
-        loss_dual.backward()
-        self.dual_optimizer.step()
 
         # Lagrangian Primal Problem
         # Combine losses.
@@ -469,31 +821,17 @@ class AgentMPO():
         loss = loss_policy + loss_kl_penalty
         # loss_dual = loss_alpha_mean + loss_alpha_stddev
 
-        self.act_optimizer.zero_grad()
-        loss.backward()
-        self.act_optimizer.step()
-
-        # self.update_index += 1
-        # if self.update_index // self.update_period == 1:
-        #     self.soft_update(self.act_target, self.act, 1.)
-        #     self.update_index = 0
-        self.soft_update(self.act_target, self.act, self.soft_update_tau)
-
-        # debug
-        self.train_record.update(a_avg=alpha_mean.mean().item(),
-                                 a_std=alpha_stddev.mean().item(),
-                                 t=temperature.item(),
-                                 obj_a=loss_policy.item(),
-                                 obj_c=obj_critic.item(),
-                                 obj_t=loss_temperature.item(),
-                                 obj_d=loss_dual.item(),
-                                 kl_mean=torch.distributions.kl_divergence(target_pi, fixed_stddev_dist).mean(
-                                     dim=0).item(),
-                                 kl_std=torch.distributions.kl_divergence(target_pi, fixed_mean_dist).mean(
-                                     dim=0).item(),
-                                 est_q=torch.max(target_q, dim=0)[0].mean().item(),
-                                 )
-        return self.train_record
+        record_values = torch.stack((alpha_mean.mean(),
+                                     alpha_stddev.mean(),
+                                     temperature.mean(),
+                                     loss_policy,
+                                     loss_temperature.mean(),
+                                     loss_dual.mean(),
+                                     kl_mean.mean(dim=0),
+                                     kl_stddev.mean(dim=0),
+                                     torch.max(target_q, dim=0)[0].mean(),
+                                     )).detach()
+        return loss, loss_dual, record_values
 
     # def get_obj_critic_raw(self, buffer, batch_size):
     #     with torch.no_grad():
@@ -510,28 +848,63 @@ class AgentMPO():
     #     obj_critic = self.criterion(q1, q_label) + self.criterion(q2, q_label)
     #     return obj_critic, target_pi, next_q, next_s
 
-    def get_obj_critic_raw(self, buffer, batch_size):
+    def get_obj_critic_raw(self, buffer, batch_size, batch=None):
         with torch.no_grad():
-            reward, mask, action, state, next_s = buffer.sample_batch(batch_size)
-            reward = reward.to(self.device)
-            mask = mask.to(self.device)
-            action = action.to(self.device)
-            state = state.to(self.device)
-            next_s = next_s.to(self.device)
-
-            target_pi = self.act_target.get_distribution(next_s)
+            if batch is None:
+                batch = buffer.sample_batch(batch_size, device=self.device)
+            reward, mask, action, state, next_s = batch
+
+            target_loc, target_cholesky = self.act_target.get_loc_cholesky(next_s)
+            target_pi = self.act_target.build_distribution(target_loc, target_cholesky)
             sampled_next_a = target_pi.sample((self._num_samples,))  # (N, B, dim-action)
-            ex_next_s = next_s[None, ...].expand(self._num_samples, -1, -1)  # (N, B, dim-action)
-            ex_next_q = torch.min(*self.cri_target.get_q1_q2(
-                ex_next_s.reshape(-1, self.state_dim),
-                sampled_next_a.tanh().reshape(-1, self.action_dim)
+            ex_next_q = torch.min(*self.cri_target.get_q1_q2_sampled(
+                next_s,
+                sampled_next_a.tanh()
             )).reshape(self._num_samples, batch_size)
             next_q = ex_next_q.mean(dim=0).unsqueeze(dim=1)
             q_label = reward + mask * next_q
 
         q1, q2 = self.cri.get_q1_q2(state, action.tanh())
         obj_critic = self.criterion(q1, q_label) + self.criterion(q2, q_label)
-        return obj_critic, target_pi, ex_next_q, next_s, sampled_next_a
+        return obj_critic, target_pi, target_loc, target_cholesky, ex_next_q, next_s, sampled_next_a
+
+    def get_obj_critic_laber(self, buffer, batch_size, batch=None):
+        """down-sample the large batch of LaBERBuffer to batch_size, with the probability of |TD-error|
+
+        the down-sampled data are weighted by mean(priority) / priority, (LaBER-mean)
+        """
+        with torch.no_grad():
+            if batch is None:
+                batch = buffer.sample_batch(batch_size, device=self.device)
+            reward, mask, action, state, next_s = batch
+            large_size = reward.shape[0]
+
+            target_loc, target_cholesky = self.act_target.get_loc_cholesky(next_s)
+            target_pi = self.act_target.build_distribution(target_loc, target_cholesky)
+            sampled_next_a = target_pi.sample((self._num_samples,))  # (N, mB, dim-action)
+            ex_next_q = torch.min(*self.cri_target.get_q1_q2_sampled(
+                next_s,
+                sampled_next_a.tanh()
+            )).reshape(self._num_samples, large_size)
+            next_q = ex_next_q.mean(dim=0).unsqueeze(dim=1)
+            q_label = reward + mask * next_q
+
+            q1, q2 = self.cri.get_q1_q2(state, action.tanh())
+            priority = ((q1 - q_label).abs() + (q2 - q_label).abs()).squeeze(1) * 0.5 + 1e-6  # (mB,)
+            indices = torch.multinomial(priority, batch_size, replacement=True)  # (B,)
+            is_weights = (priority.mean() / priority[indices]).unsqueeze(1)
+
+            target_loc = target_loc[indices]
+            target_cholesky = target_cholesky[indices]
+            target_pi = self.act_target.build_distribution(target_loc, target_cholesky)
+            sampled_next_a = sampled_next_a[:, indices]
+            ex_next_q = ex_next_q[:, indices]
+            next_s = next_s[indices]
+            q_label = q_label[indices]
+
+        q1, q2 = self.cri.get_q1_q2(state[indices], action[indices].tanh())
+        obj_critic = ((self.criterion(q1, q_label) + self.criterion(q2, q_label)) * is_weights).mean()
+        return obj_critic, target_pi, target_loc, target_cholesky, ex_next_q, next_s, sampled_next_a
 
     def compute_temperature_loss(self,
                                  q_values: torch.Tensor,
@@ -606,9 +979,9 @@ class AgentMPO():
 
         if if_save:
             if self.act is not None:
-                torch.save(self.act.state_dict(), act_save_path)
+                save_state_dict(self.act.state_dict(), act_save_path)
             if self.cri is not None:
-                torch.save(self.cri.state_dict(), cri_save_path)
+                save_state_dict(self.cri.state_dict(), cri_save_path)
         elif (self.act is not None) and os.path.exists(act_save_path):
             load_torch_file(self.act, act_save_path)
             print("Loaded act:", cwd)
@@ -619,27 +992,28 @@ class AgentMPO():
             print("FileNotFound when load_model: {}".format(cwd))
 
     @staticmethod
-    def soft_update(target_net, current_net, tau):
+    @torch.no_grad()
+    def soft_update(tar_params, cur_params, tau):
         """soft update a target network via current network
 
-        :nn.Module target_net: target network update via a current network, it is more stable
-        :nn.Module current_net: current network update via an optimizer
+        :list tar_params: parameters of the target network, update via a current network, it is more stable
+        :list cur_params: parameters of the current network, update via an optimizer
+        one multi-tensor `_foreach` op updates all parameters, tar = tar + tau * (cur - tar)
         """
-        for tar, cur in zip(target_net.parameters(), current_net.parameters()):
-            tar.data.copy_(cur.data.__mul__(tau) + tar.data.__mul__(1 - tau))
+        torch._foreach_lerp_(tar_params, cur_params, tau)
 
     def to_cpu(self):
-        device = torch.device('cpu')
-        if next(self.act.parameters()).is_cuda:
+        if self.if_on_device:
+            device = torch.device('cpu')
             self.act.to(device)
-        if next(self.cri.parameters()).is_cuda:
             self.cri.to(device)
+            self.if_on_device = False
 
     def to_device(self):
-        if not next(self.act.parameters()).is_cuda:
+        if not self.if_on_device:
             self.act.to(self.device)
-        if not next(self.cri.parameters()).is_cuda:
             self.cri.to(self.device)
+            self.if_on_device = True
 
 
 def make_env(env_dict, seed=0):
@@ -649,6 +1023,35 @@ def make_env(env_dict, seed=0):
     return env
 
 
+def make_vec_env(env_dict, seed=0, env_num=1, if_async=False):
+    """a vector env of env_num envs, seeded with seed, seed + 1, ...
+
+    AsyncVectorEnv steps each env in a subprocess, SyncVectorEnv steps them in turn.
+    Each env is done after env_dict['max_step'] steps at most, see gym.wrappers.TimeLimit.
+    An env resets itself when it is done, and the vector env returns the first state of the new episode.
+    """
+    import gym
+    env_fns = [lambda i=i: gym.wrappers.TimeLimit(make_env(env_dict, seed + i),
+                                                  max_episode_steps=env_dict['max_step'])
+               for i in range(env_num)]
+    return gym.vector.AsyncVectorEnv(env_fns) if if_async else gym.vector.SyncVectorEnv(env_fns)
+
+
+def save_state_dict(state_dict, save_path):
+    """save a copy of state_dict on CPU, the network stays on its device
+
+    the file is serialized in RAM and written once to a temporary file,
+    then `os.replace` swaps it in, so a crash never leaves a broken checkpoint at save_path.
+    """
+    state_dict = {k: v.detach().cpu() for k, v in state_dict.items()}
+    buf = io.BytesIO()
+    torch.save(state_dict, buf)
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buf.getbuffer())
+    os.replace(tmp_path, save_path)
+
+
 class TensorBoard:
     _writer = None
 
@@ -656,17 +1059,34 @@ class TensorBoard:
     def get_writer(cls, load_path=None):
         if cls._writer:
             return cls._writer
-        cls._writer = SummaryWriter(load_path)
+        # the event file is written by a background thread of SummaryWriter,
+        # a large queue and a long flush interval, events are written to disk in a few big blocks
+        cls._writer = SummaryWriter(load_path, max_queue=100000, flush_secs=600, filename_suffix='')
         return cls._writer
 
+    @classmethod
+    def flush(cls):
+        """write the queued events to disk, only call it at the rare break points (save model, end of training)
+        """
+        if cls._writer:
+            cls._writer.flush()
+
 
 class RecordEpisode:
-    def __init__(self):
-        self.l_reward = []
+    def __init__(self, max_step=1000):
+        """record the rewards of one episode in a preallocated array
+
+        `int max_step` the initial capacity, it grows when an episode is longer than it
+        """
+        self.rewards = np.empty(max_step, dtype=np.float32)
+        self.now_len = 0
         self.record = {}
 
     def add_record(self, reward, info=None):
-        self.l_reward.append(reward)
+        if self.now_len == self.rewards.shape[0]:
+            self.rewards = np.concatenate((self.rewards, np.empty_like(self.rewards)))
+        self.rewards[self.now_len] = reward
+        self.now_len += 1
         if info is not None:
             for k, v in info.items():
                 if k not in self.record.keys():
@@ -675,33 +1095,56 @@ class RecordEpisode:
 
     def get_result(self):
         results = {}
-        results['episode'] = {}
         #######Reward#######
-        rewards = np.array(self.l_reward)
-        results['episode']['avg_reward'] = rewards.mean()
-        results['episode']['std_reward'] = rewards.std()
-        results['episode']['max_reward'] = rewards.max()
-        results['episode']['min_reward'] = rewards.min()
-        results['episode']['return'] = rewards.sum()
+        rewards = self.rewards[:self.now_len]
+        results['episode'] = {'avg_reward': rewards.mean(),
+                              'std_reward': rewards.std(),
+                              'max_reward': rewards.max(),
+                              'min_reward': rewards.min(),
+                              'return': rewards.sum()}
         #######Total#######
-        results['total'] = {}
-        results['total']['step'] = rewards.shape[0]
-
+        results['total'] = {'step': self.now_len}
         return results
 
     def clear(self):
-        self.l_reward = []
+        self.now_len = 0
         self.record = {}
 
 
+def _calc_stats(np_array):  # np_array.shape==(leaf_num, episode_num)
+    leaf_num, size = np_array.shape
+    stats = np.empty((5, leaf_num))
+    for j in range(leaf_num):
+        row = np.sort(np_array[j])  # max, min and median are read from the sorted copy
+        avg = row.mean()
+        stats[0, j] = avg
+        stats[1, j] = np.sqrt(((row - avg) ** 2).mean())
+        stats[2, j] = row[-1]
+        stats[3, j] = row[0]
+        stats[4, j] = (row[(size - 1) // 2] + row[size // 2]) / 2
+    return stats
+
+
+if numba is not None:
+    _calc_stats = numba.njit(cache=True)(_calc_stats)
+
+
 def calc(np_array):
-    if len(np_array.shape) > 1:
-        np_array = np_array.sum(dim=1)
-    return {'avg': np_array.mean(),
-            'std': np_array.std(),
-            'max': np_array.max(),
-            'min': np_array.min(),
-            'mid': np.median(np_array)}
+    """the statistics of each row, all the leaves of a record are stacked and reduced at once
+
+    :array np_array: np_array.shape==(leaf_num, episode_num)
+    :return dict: {'avg', 'std', 'max', 'min', 'mid'}, each value.shape==(leaf_num, )
+    """
+    if numba is not None:
+        stats = _calc_stats(np.ascontiguousarray(np_array, dtype=np.float64))
+    else:
+        size = np_array.shape[1]
+        rows = np.sort(np_array, axis=1)  # max, min and median are read from the sorted copy
+        avg = rows.mean(axis=1)
+        std = np.sqrt(((rows - avg[:, None]) ** 2).mean(axis=1))
+        mid = (rows[:, (size - 1) // 2] + rows[:, size // 2]) / 2
+        stats = (avg, std, rows[:, -1], rows[:, 0], mid)
+    return dict(zip(('avg', 'std', 'max', 'min', 'mid'), stats))
 
 
 class Evaluator():
@@ -721,6 +1164,12 @@ class Evaluator():
         self.total_time = 0
         self.train_record = {}
         self.eval_record = {}
+        self.eval_states = None  # the states of eval envs, (page-locked if the actor runs on GPU)
+        self.eval_states_dev = None  # eval_states on the device of the actor
+        self.eval_actions = None  # the actions of eval envs on CPU, overwritten every step
+        self.eval_episodes = []  # RecordEpisode of each eval env
+        self.print_keys = None  # the keys of algo_record in print_header
+        self.print_header = None
 
     def add_train_record(self, result):
         if len(self.train_record) == 0:
@@ -744,6 +1193,44 @@ class Evaluator():
                 for i, v in result[k].items():
                     self.eval_record[k][i].append(v)
 
+    def evaluate(self, agent, eval_env, env_max_step):
+        """run one episode in each env of eval_env, and add the results into eval_record
+
+        the states of all eval envs go through the actor in one batch every step,
+        from a staging tensor on CPU with a non-blocking copy. The actions are copied into a tensor on CPU
+        which is overwritten every step. An env that is done resets itself, its later steps are not recorded.
+        :VectorEnv eval_env: the vector env for evaluation, eval_env.num_envs==eval_times, see make_vec_env()
+        """
+        env_num = eval_env.num_envs
+        if self.eval_states is None:
+            if_pin = agent.device.type == 'cuda'
+            self.eval_states = torch.empty((env_num, agent.state_dim), dtype=torch.float32, pin_memory=if_pin)
+            self.eval_states_dev = torch.empty_like(self.eval_states, device=agent.device) \
+                if if_pin else self.eval_states
+            self.eval_actions = torch.empty((env_num, agent.action_dim), dtype=torch.float32, pin_memory=if_pin)
+            self.eval_episodes = [RecordEpisode(env_max_step) for _ in range(env_num)]
+        states = self.eval_states.numpy()  # shares the memory of eval_states
+        actions = self.eval_actions.numpy()
+        states[:] = eval_env.reset()
+        for episode in self.eval_episodes:
+            episode.clear()
+
+        if_alive = np.ones(env_num, dtype=bool)  # the envs that are not done
+        for i in range(env_max_step):
+            if self.eval_states_dev is not self.eval_states:
+                self.eval_states_dev.copy_(self.eval_states, non_blocking=True)
+            with torch.inference_mode():
+                self.eval_actions.copy_(agent.act_eval(self.eval_states_dev))  # no new array for the actions
+            next_s, rewards, dones, _ = eval_env.step(actions)
+            for env_id in np.flatnonzero(if_alive):
+                self.eval_episodes[env_id].add_record(rewards[env_id])
+            if_alive &= ~dones
+            if not if_alive.any():
+                break
+            states[:] = next_s
+        for episode in self.eval_episodes:
+            self.add_eval_record(episode.get_result())
+
     def clear_train_and_eval_record(self):
         self.train_record = {}
         self.eval_record = {}
@@ -752,15 +1239,23 @@ class Evaluator():
         self.curr_step = totalstep
         self.total_step += totalstep
 
+    @staticmethod
+    def analyze_record(record):
+        """replace each list of per-episode values in record with its statistics
+
+        the leaves are stacked into one array, (a leaf of vectors is summed into scalars first)
+        """
+        leaf_keys = [(k, i) for k in record.keys() for i in record[k].keys()]
+        leaves = [np.asarray(record[k][i], dtype=np.float64) for k, i in leaf_keys]
+        stats = calc(np.stack([leaf.sum(axis=1) if leaf.ndim > 1 else leaf for leaf in leaves]))
+        for j, (k, i) in enumerate(leaf_keys):
+            record[k][i] = {name: value[j] for name, value in stats.items()}
+
     def analyze_result(self):
         if len(self.train_record) > 0:
-            for k in self.train_record.keys():
-                for i, v in self.train_record[k].items():
-                    self.train_record[k][i] = calc(np.array(v))
+            self.analyze_record(self.train_record)
         if len(self.eval_record) > 0:
-            for k in self.eval_record.keys():
-                for i, v in self.eval_record[k].items():
-                    self.eval_record[k][i] = calc(np.array(v))
+            self.analyze_record(self.eval_record)
             _return = self.eval_record['episode']['return']['avg']
         else:
             _return = self.train_record['episode']['return']['avg']
@@ -771,29 +1266,36 @@ class Evaluator():
                 self.record_satisfy_reward = True
 
     def tb_algo(self, algo_record):
-        for k, v in algo_record.items():
-            self.writer.add_scalar(f'algo/{k}', v, self.total_step - self.curr_step)
+        self.tb_write({f'algo/{k}': v for k, v in algo_record.items()})
 
     def tb_train(self):
-        for k in self.train_record.keys():
-            for i, elements in self.train_record[k].items():
-                for calc, v in elements.items():
-                    self.writer.add_scalar(f'train_{k}_{i}/{calc}', v, self.total_step - self.curr_step)
+        self.tb_write({f'train_{k}_{i}/{calc}': v
+                       for k, record in self.train_record.items()
+                       for i, elements in record.items()
+                       for calc, v in elements.items()})
 
     def tb_eval(self):
-        for k in self.eval_record.keys():
-            for i, elements in self.eval_record[k].items():
-                for calc, v in elements.items():
-                    self.writer.add_scalar(f'eval_{k}_{i}/{calc}', v, self.total_step - self.curr_step)
+        self.tb_write({f'eval_{k}_{i}/{calc}': v
+                       for k, record in self.eval_record.items()
+                       for i, elements in record.items()
+                       for calc, v in elements.items()})
+
+    def tb_write(self, scalars):
+        """add the flat dict {tag: value} of one step into the event queue of the writer, without flush
+        """
+        step = self.total_step - self.curr_step
+        for tag, v in scalars.items():
+            self.writer.add_scalar(tag, v, step)
 
     def iter_print(self, algo_record, eval_record, use_time):
-        print_info = f"|{'Step':>8}  {'MaxR':>8}|" + \
-                     f"{'avgR':>8}  {'stdR':>8}" + \
-                     f"{'avgS':>6}  {'stdS':>4} |"
-        for key in algo_record.keys():
-            print_info += f"{key:>8}"
-        print_info += " |"
-        print(print_info)
+        algo_keys = tuple(algo_record.keys())
+        if algo_keys != self.print_keys:  # the header only changes with the keys of algo_record
+            self.print_keys = algo_keys
+            self.print_header = f"|{'Step':>8}  {'MaxR':>8}|" + \
+                                f"{'avgR':>8}  {'stdR':>8}" + \
+                                f"{'avgS':>6}  {'stdS':>4} |" + \
+                                "".join(f"{key:>8}" for key in algo_keys) + " |"
+        print(self.print_header)
         print_info = f"|{self.total_step:8.2e}  {self.curr_max_return:8.2f}|" + \
                      f"{eval_record['episode']['return']['avg']:8.2f}  {eval_record['episode']['return']['std']:8.2f}" + \
                      f"{eval_record['total']['step']['avg']:6.2f}  {eval_record['total']['step']['std']:4.0f} |"
@@ -809,22 +1311,23 @@ class Evaluator():
 
     def save_model(self, agent):
         if self.if_save_model:
-            agent.to_cpu()
             act_save_path = f'{self.cwd}/actor.pth'
-            torch.save(agent.act.state_dict(), act_save_path)
+            save_state_dict(agent.act.state_dict(), act_save_path)
             if agent.cri is None:
                 for i in range(len(agent.cris)):
                     cri_save_path = f'{self.cwd}/critic{i}.pth'
-                    torch.save(agent.cris[i].state_dict(), cri_save_path)
+                    save_state_dict(agent.cris[i].state_dict(), cri_save_path)
             else:
                 cri_save_path = f'{self.cwd}/critic.pth'
-                torch.save(agent.cri.state_dict(), cri_save_path)
+                save_state_dict(agent.cri.state_dict(), cri_save_path)
+            TensorBoard.flush()  # the TensorBoard events until the saved model
         self.if_save_model = False
 
 
 default_config = {
     'cwd': None,
     'if_cwd_time': True,
+    'if_remove': False,  # remove the history in cwd, else save in cwd_1, cwd_2, ...
     'random_seed': 0,
     'gpu_id': 1,  # <0 cpu
     'load_buffer_path': None,
@@ -848,6 +1351,8 @@ default_config = {
         'learning_rate': 1e-4,
         'soft_update_tau': 2 ** -8,
         'net_dim': 2 ** 8,
+        'if_diag_cov': False,  # diagonal covariance policy is much cheaper for large action_dim
+        'if_compile': False,  # torch.compile the MPO losses and the actor for evaluation, need PyTorch 2
     },
     'interactor': {
         'sample_size': 1000,  # evaluation gap
@@ -857,13 +1362,17 @@ default_config = {
         'policy_reuse': 2 ** 1,  # no work
         'interact_model': 'one',
         'random_explore_num': 1000,
+        'gradient_every': 8,  # for interact_model 'one', do the network updates of 8 env steps at once
     },
     'buffer': {
         'max_buf': 2 ** 20,
         'if_per': False,  # for off policy
+        'if_laber': False,  # Large Batch Experience Replay, instead of PER
+        'laber_m': 4,  # the large batch of LaBER is laber_m * batch_size
     },
     'evaluator': {
         'eval_times': 4,  # for every rollout_worker
+        'num_workers': 4,  # the envs of random explore, >1 steps them and the eval_times eval envs in subprocesses
         'break_step': 1e6,
         'eval_gap_step': 1e4,
         'satisfy_reward_stop': False,
@@ -879,6 +1388,8 @@ class Arguments:
         self.cwd = config['cwd'] if 'cwd' in config.keys() else None
         # current work directory with time.
         self.if_cwd_time = config['if_cwd_time'] if 'cwd' in config.keys() else False
+        # remove the history in cwd, else a new cwd with a numbered suffix is used
+        self.if_remove = config['if_remove'] if 'if_remove' in config.keys() else False
         # initialize random seed in self.init_before_training()
         self.random_seed = config['random_seed']
         self.load_buffer_path = config['load_buffer_path'] if 'load_buffer_path' in config.keys() else None
@@ -891,7 +1402,7 @@ class Arguments:
         self.interactor = config['interactor']
         self.buffer = config['buffer']
         self.evaluator = config['evaluator']
-        self.config = default_config
+        self.config = config
 
     def init_before_training(self, if_main=True):
         '''set cwd automatically'''
@@ -904,19 +1415,25 @@ class Arguments:
             self.cwd = f'./logs/{self.env["id"]}-{self.agent["agent_name"]}/' \
                        f'exp_{self.interactor["interact_model"]}_{curr_time}_{self.device_name}'
 
-        import shutil  # remove history according to bool(if_remove)
-        shutil.rmtree(self.cwd, ignore_errors=True)
-        print("| Remove history")
-        os.makedirs(self.cwd, exist_ok=True)
+        if self.if_remove and os.path.exists(self.cwd):
+            import shutil  # remove history according to bool(if_remove)
+            shutil.rmtree(self.cwd, ignore_errors=True)
+            print("| Remove history")
+        cwd, k = self.cwd, 0
+        while True:  # makedirs fails if the directory exists, so concurrent runs never share a cwd
+            try:
+                os.makedirs(self.cwd)
+                break
+            except FileExistsError:
+                k += 1
+                self.cwd = f'{cwd}_{k}'
         '''save exp parameters'''
-        from ruamel.yaml.main import YAML
-        yaml = YAML()
-        del self.config['agent']['class_name']
-        del self.config['if_cwd_time']
-        self.config['cwd'] = self.cwd
+        import json  # JSON is a subset of YAML, so parameters.yaml is still readable as YAML
+        config = {k: v for k, v in self.config.items() if k != 'if_cwd_time'}
+        config['agent'] = {k: v for k, v in config['agent'].items() if k != 'class_name'}
+        config['cwd'] = self.cwd
         with open(self.cwd + '/parameters.yaml', 'w', encoding="utf-8") as f:
-            yaml.dump(self.config, f)
-        del self.config
+            json.dump(config, f, indent=2, default=str)
 
         torch.set_default_dtype(torch.float32)
         torch.manual_seed(self.random_seed)
@@ -928,22 +1445,38 @@ def interact(config=default_config):
     args.init_before_training()
     agent = args.agent['class_name'](args=args)
     env = make_env(args.env, args.random_seed)
-    eval_env = make_env(args.env, args.random_seed)
+    num_workers = args.evaluator.get('num_workers', 4)  # the envs of random explore, see default_config
+    eval_env = make_vec_env(args.env, args.random_seed, args.evaluator['eval_times'], if_async=num_workers > 1)
     agent.init(net_dim=args.agent['net_dim'],
                state_dim=args.env['state_dim'],
                action_dim=args.env['action_dim'],
-               if_per=args.buffer['if_per'])
-    buffer = ReplayBuffer(cwd=args.cwd,
-                          max_len=args.buffer['max_buf'],
-                          state_dim=args.env['state_dim'],
-                          action_dim=1 if args.env['if_discrete_action'] else args.env['action_dim'],
-                          if_per=args.buffer['if_per'],
-                          if_save_buffer=args.buffer['if_save_buffer'])
+               if_per=args.buffer['if_per'],
+               if_laber=args.buffer.get('if_laber', False))
+    if agent.if_compile:
+        agent.compile_act(batch_size=args.evaluator['eval_times'])
+    if args.buffer.get('if_laber', False):
+        buffer = LaBERBuffer(cwd=args.cwd,
+                             max_len=args.buffer['max_buf'],
+                             state_dim=args.env['state_dim'],
+                             action_dim=1 if args.env['if_discrete_action'] else args.env['action_dim'],
+                             laber_m=args.buffer.get('laber_m', 4),
+                             if_save_buffer=args.buffer['if_save_buffer'],
+                             reward_scale=args.interactor['reward_scale'],
+                             gamma=args.interactor['gamma'])
+    else:
+        buffer = ReplayBuffer(cwd=args.cwd,
+                              max_len=args.buffer['max_buf'],
+                              state_dim=args.env['state_dim'],
+                              action_dim=1 if args.env['if_discrete_action'] else args.env['action_dim'],
+                              if_per=args.buffer['if_per'],
+                              if_save_buffer=args.buffer['if_save_buffer'],
+                              reward_scale=args.interactor['reward_scale'],
+                              gamma=args.interactor['gamma'])
     evaluator = Evaluator(args)
     env_max_step = args.env['max_step']
-    reward_scale = args.interactor['reward_scale']
-    gamma = args.interactor['gamma']
     random_explore_num = args.interactor['random_explore_num']
+    gradient_every = args.interactor.get('gradient_every', 1)
+    explore_rate = args.agent['explore_rate']
     break_step = args.evaluator['break_step']
     sample_size = args.interactor['sample_size']
     batch_size = args.interactor['batch_size']
@@ -953,51 +1486,63 @@ def interact(config=default_config):
 
     ### random explore
     if args.load_buffer_path is None:
+        # num_workers envs explore together, an episode is written into buffer by one extend_buffer when it ends
+        explore_env = make_vec_env(args.env, args.random_seed, num_workers, if_async=num_workers > 1)
+        worker_ids = np.arange(num_workers)
+        ep_state = np.empty((num_workers, env_max_step, buffer.state_dim), dtype=np.float32)
+        ep_action = np.empty((num_workers, env_max_step, buffer.action_dim), dtype=np.float32)
+        ep_reward = np.empty((num_workers, env_max_step), dtype=np.float32)
+        ep_done = np.zeros((num_workers, env_max_step), dtype=bool)
+        ep_len = np.zeros(num_workers, dtype=np.int64)
         actual_step = 0
+        states = explore_env.reset()
         while actual_step < random_explore_num:
-            state = env.reset()
-            for i in range(env_max_step):
-                action = env.action_space.sample()
-                next_s, reward, done, _ = env.step(action)
-                done = True if i == (env_max_step - 1) else done
-                buffer.append_buffer(state,
-                                     action,
-                                     reward * reward_scale,
-                                     0.0 if done else gamma)
-                if done:
-                    break
-                state = next_s
-            actual_step += i
+            actions = explore_env.action_space.sample()
+            next_s, rewards, dones, _ = explore_env.step(actions)
+            ep_state[worker_ids, ep_len] = states
+            ep_action[worker_ids, ep_len] = actions.reshape(num_workers, -1)
+            ep_reward[worker_ids, ep_len] = rewards
+            ep_len += 1
+            for w in np.flatnonzero(dones):
+                i = ep_len[w] - 1
+                ep_done[w, i] = True  # the episode ends with done
+                buffer.extend_buffer(ep_state[w, :i + 1], ep_action[w, :i + 1], ep_reward[w, :i + 1],
+                                     ep_done[w, :i + 1])
+                ep_done[w, i] = False
+                ep_len[w] = 0
+                actual_step += i
+            states = next_s
+        explore_env.close()
         buffer.save_buffer(file_name='buffer_random_explore')
     else:
         buffer.load_buffer(args.load_buffer_path)
 
     total_step = 0
-    record_episode = RecordEpisode()
+    record_episode = RecordEpisode(env_max_step)
     ### interact one step model
     if interact_model == 'one':
         start_time = time.time()
-        agent.to_cpu()
         record_t = 0
+        pending = 0  # the number of env steps whose network update is not done yet
         while (total_step < break_step):
             state = env.reset()
             for i in range(env_max_step):
                 total_step += 1
-                action = agent.select_action(agent.act, state, explore_rate=args.agent['explore_rate'])
-                next_s, reward, done, _ = env.step(np.tanh(action))
+                action, action_tanh = agent.select_action(agent.act, state, explore_rate=explore_rate)
+                next_s, reward, done, _ = env.step(action_tanh)
                 done = True if i == (env_max_step - 1) else done
-                buffer.append_buffer(state,
-                                     action,
-                                     reward * reward_scale,
-                                     0.0 if done else gamma)
+                buffer.append_buffer(state, action, reward, done)
                 record_episode.add_record(reward)
                 if_record = total_step // eval_gap_step - record_t
                 record_t = total_step // eval_gap_step
-                ### update agent network
-                buffer.update_now_len_before_sample()
-                agent.to_device()
-                algo_record = agent.update_net_one_step(buffer, batch_size, if_record=if_record)
-                agent.to_cpu()
+                ### update agent network, `gradient_every` updates at once, one update for each env step
+                pending += 1
+                if pending >= gradient_every or if_record:
+                    buffer.update_now_len_before_sample()
+                    for j in range(pending):
+                        algo_record = agent.update_net_one_step(buffer, batch_size,
+                                                                if_record=if_record and j == pending - 1)
+                    pending = 0
 
                 if done:
                     evaluator.add_train_record(record_episode.get_result())
@@ -1008,18 +1553,7 @@ def interact(config=default_config):
                 if if_record:
                     evaluator.update_totalstep(sample_size)
                     ### evaluate in env
-                    for _ in range(evaluator.eval_times):
-                        state = eval_env.reset()
-                        for i in range(env_max_step):
-                            action = agent.act(torch.as_tensor((state,), dtype=torch.float32).detach_())
-                            next_s, reward, done, _ = eval_env.step(action.detach().numpy()[0])
-                            done = True if i == (env_max_step - 1) else done
-                            record_episode.add_record(reward)
-                            if done:
-                                break
-                            state = next_s
-                        evaluator.add_eval_record(record_episode.get_result())
-                        record_episode.clear()
+                    evaluator.evaluate(agent, eval_env, env_max_step)
 
                     ### record in tb
                     evaluator.analyze_result()
@@ -1030,9 +1564,12 @@ def interact(config=default_config):
                     evaluator.save_model(agent)
                     evaluator.clear_train_and_eval_record()
                     start_time = time.time()
+        if pending:  # the updates of the last env steps
+            buffer.update_now_len_before_sample()
+            for _ in range(pending):
+                agent.update_net_one_step(buffer, batch_size, if_record=False)
     ### interact multi-step model
     elif interact_model == 'multi':
-        agent.to_cpu()
         record_t = 0
         while (total_step < break_step):
             start_time = time.time()
@@ -1041,13 +1578,10 @@ def interact(config=default_config):
             while actual_step < sample_size:
                 state = env.reset()
                 for i in range(env_max_step):
-                    action = agent.select_action(agent.act, state, explore_rate=args.agent['explore_rate'])
-                    next_s, reward, done, _ = env.step(np.tanh(action))
+                    action, action_tanh = agent.select_action(agent.act, state, explore_rate=explore_rate)
+                    next_s, reward, done, _ = env.step(action_tanh)
                     done = True if i == (env_max_step - 1) else done
-                    buffer.append_buffer(state,
-                                         action,
-                                         reward * reward_scale,
-                                         0.0 if done else gamma)
+                    buffer.append_buffer(state, action, reward, done)
                     record_episode.add_record(reward)
                     actual_step += 1
                     if done:
@@ -1058,30 +1592,17 @@ def interact(config=default_config):
             total_step += actual_step
             ### update agent network
             buffer.update_now_len_before_sample()
-            agent.to_device()
             algo_record = agent.update_net_multi_step(buffer=buffer,
                                                       target_step=actual_step,
                                                       batch_size=batch_size,
                                                       repeat_times=policy_reuse)
-            agent.to_cpu()
             evaluator.update_totalstep(actual_step)
 
             if_record = total_step // eval_gap_step - record_t
             record_t = total_step // eval_gap_step
             if if_record:
                 ### evaluate in env
-                for _ in range(evaluator.eval_times):
-                    state = eval_env.reset()
-                    for i in range(env_max_step):
-                        action = agent.act(torch.as_tensor((state,), dtype=torch.float32).detach_())
-                        next_s, reward, done, _ = eval_env.step(action.detach().numpy()[0])
-                        done = True if i == (env_max_step - 1) else done
-                        record_episode.add_record(reward)
-                        if done:
-                            break
-                        state = next_s
-                    evaluator.add_eval_record(record_episode.get_result())
-                    record_episode.clear()
+                evaluator.evaluate(agent, eval_env, env_max_step)
 
                 ### record in tb
                 evaluator.analyze_result()
@@ -1091,12 +1612,15 @@ def interact(config=default_config):
                 evaluator.iter_print(algo_record, evaluator.eval_record, (time.time() - start_time))
                 evaluator.save_model(agent)
                 evaluator.clear_train_and_eval_record()
+    eval_env.close()
+    TensorBoard.flush()
 
 
 def demo_test_one_step_mpo():
     mpo_config = {
         'cwd': None,
         'if_cwd_time': False,
+        'if_remove': True,
         'random_seed': 0,
         'gpu_id': 1,  # <0 cpu
         'load_buffer_path': None,
@@ -1136,6 +1660,8 @@ def demo_test_one_step_mpo():
             'learning_rate': 1e-4,
             'soft_update_tau': 2 ** -8,
             'net_dim': 2 ** 8,
+            'if_diag_cov': False,
+            'if_compile': False,
         },
         'interactor': {
             'sample_size': 1000,  # no work
@@ -1145,14 +1671,18 @@ def demo_test_one_step_mpo():
             'policy_reuse': 2 ** 1,  # no work
             'interact_model': 'one',
             'random_explore_num': 1000,
+            'gradient_every': 8,  # for interact_model 'one', do the network updates of 8 env steps at once
         },
         'buffer': {
             'max_buf': 2 ** 20,
             'if_per': False,  # for off policy
+            'if_laber': False,  # Large Batch Experience Replay, instead of PER
+            'laber_m': 4,  # the large batch of LaBER is laber_m * batch_size
             'if_save_buffer': False,
         },
         'evaluator': {
             'eval_times': 4,  # for every rollout_worker
+            'num_workers': 4,  # the envs of random explore, >1 steps them and the eval_times eval envs in subprocesses
             'break_step': 1e6,
             'eval_gap_step': 6e3,
             'satisfy_reward_stop': False,